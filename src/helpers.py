@@ -1,14 +1,12 @@
 import logging
 import argparse
-import re
+import mmap
 import jpeglib
 import cv2
 import pyexiv2
 import numpy as np
 import matplotlib.pyplot as plt
 
-from bitarray import bitarray
-from skimage.metrics import structural_similarity
 from steganography import lsb_steganography
 from steganography import dct_steganography
 
@@ -16,16 +14,18 @@ from steganography import dct_steganography
 def storage_stats_jpeg(filename: str) -> None:
     logging.info(f"Preparing storage statistics for '{filename}.jpg'...")
 
-    for perceptibility in range(1, 9):
-        image = dct_steganography.JpegImage.from_file(f"../assets/jpeg/{filename}.jpg", perceptibility)
-        logging.info(f"For perceptibility {perceptibility}: {image.storage_capacity}B")
+    capacity_table = dct_steganography.JpegImage.capacity_table(f"../assets/jpeg/{filename}.jpg")
+    for perceptibility, storage_capacity in capacity_table.items():
+        logging.info(f"For perceptibility {perceptibility}: {storage_capacity}B")
 
 
 def storage_stats_png(filename: str) -> None:
     logging.info(f"Preparing storage statistics for '{filename}.png'...")
 
+    image = lsb_steganography.PngImage.from_file(f"../assets/png/{filename}.png")
+
     for number_of_least_significant_bit in range(1, 5):
-        image = lsb_steganography.PngImage.from_file(f"../assets/png/{filename}.png", number_of_least_significant_bit)
+        image = lsb_steganography.PngImage(image.image, image.exif, number_of_least_significant_bit)
         logging.info(f"For {number_of_least_significant_bit} least significant bits: {image.storage_capacity}B")
 
 
@@ -33,13 +33,21 @@ def histogram(source_file: str, destination: str) -> None:
     logging.info(f"Saving histogram for image '{source_file}'...")
     image = cv2.imread(source_file, cv2.IMREAD_GRAYSCALE)
 
+    frequencies = np.bincount(image.ravel(), minlength=256)
+
     plt.figure(figsize=(15, 10))
-    plt.hist(image.reshape(image.size), bins=255, color="slategrey")
+    plt.bar(np.arange(256), frequencies, width=1.0, color="slategrey")
     plt.savefig(destination, bbox_inches="tight")
 
 
 def compute_mse(image: np.ndarray, stego_image: np.ndarray) -> float:
-    return np.sum((image - stego_image) ** 2) / image.size
+    # unlike NumPy, OpenCV doesn't wrap around on uint8 differences
+    return cv2.norm(image, stego_image, cv2.NORM_L2SQR) / image.size
+
+
+def compute_psnr(image: np.ndarray, stego_image: np.ndarray) -> float:
+    mse = compute_mse(image, stego_image)
+    return float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse)
 
 
 def psnr(image_file: str, stego_file: str) -> None:
@@ -47,38 +55,89 @@ def psnr(image_file: str, stego_file: str) -> None:
     image = cv2.imread(image_file, cv2.IMREAD_UNCHANGED)
     stego_image = cv2.imread(stego_file, cv2.IMREAD_UNCHANGED)
 
-    maximum = 255
-    mse = compute_mse(image, stego_image)
-    psnr = 10 * np.log10(maximum ** 2 / mse)
-
+    psnr = compute_psnr(image, stego_image)
     logging.info(f"PSNR = {psnr:.2f}")
 
 
+def compute_local_mean(image: np.ndarray) -> np.ndarray:
+    # weighted by an 11x11 gaussian window (sigma = 1.5), keeping only the positions where the window fits in the image
+    return cv2.GaussianBlur(image, (11, 11), 1.5, borderType=cv2.BORDER_REFLECT)[5:-5, 5:-5]
+
+
+def compute_ssim(image: np.ndarray, stego_image: np.ndarray) -> float:
+    # SSIM as defined by Wang et al., like skimage's structural_similarity(gaussian_weights=True, sigma=1.5,
+    # use_sample_covariance=False)
+    data_range = float(stego_image.max()) - float(stego_image.min())
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+
+    image = image.astype(np.float64)
+    stego_image = stego_image.astype(np.float64)
+
+    mu1 = compute_local_mean(image)
+    mu2 = compute_local_mean(stego_image)
+    mu1_sq = mu1 * mu1
+    mu2_sq = mu2 * mu2
+    mu1_mu2 = mu1 * mu2
+    sigma1_sq = compute_local_mean(image * image) - mu1_sq
+    sigma2_sq = compute_local_mean(stego_image * stego_image) - mu2_sq
+    sigma12 = compute_local_mean(image * stego_image) - mu1_mu2
+
+    ssim_map = ((2 * mu1_mu2 + c1) * (2 * sigma12 + c2)) / ((mu1_sq + mu2_sq + c1) * (sigma1_sq + sigma2_sq + c2))
+    return float(ssim_map.mean())
+
+
+def convert_to_grayscale(image: np.ndarray) -> np.ndarray:
+    if image.ndim == 2:
+        return image
+
+    return cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY if image.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+
+
 def ssim(image_file: str, stego_file: str) -> None:
     logging.info(f"Computing SSIM for image '{image_file}' and stego image '{stego_file}'...")
-    image = cv2.imread(image_file, cv2.IMREAD_GRAYSCALE)
-    stego_image = cv2.imread(stego_file, cv2.IMREAD_GRAYSCALE)
+    image = convert_to_grayscale(cv2.imread(image_file, cv2.IMREAD_UNCHANGED))
+    stego_image = convert_to_grayscale(cv2.imread(stego_file, cv2.IMREAD_UNCHANGED))
+
+    ssim = compute_ssim(image, stego_image)
+    logging.info(f"SSIM = {ssim:.2f}")
+
+
+def quality_metrics(image_file: str, stego_file: str) -> None:
+    logging.info(f"Computing PSNR and SSIM for image '{image_file}' and stego image '{stego_file}'...")
+    image = cv2.imread(image_file, cv2.IMREAD_UNCHANGED)
+    stego_image = cv2.imread(stego_file, cv2.IMREAD_UNCHANGED)
+
+    psnr = compute_psnr(image, stego_image)
+    logging.info(f"PSNR = {psnr:.2f}")
 
-    ssim = structural_similarity(image, stego_image, data_range=stego_image.max() - stego_image.min())
-    logging.info(f"SSIM = {float(ssim):.2f}")
+    ssim = compute_ssim(convert_to_grayscale(image), convert_to_grayscale(stego_image))
+    logging.info(f"SSIM = {ssim:.2f}")
+
+
+def compute_middle_third_bounds(height: int, width: int) -> (slice, slice):
+    return slice(height // 3, 2 * height // 3), slice(width // 3, 2 * width // 3)
+
+
+def middle_third(image: np.ndarray) -> np.ndarray:
+    # only keep the middle third of the image in both dimensions
+    return image[compute_middle_third_bounds(*image.shape[:2])]
 
 
 def crop_jpeg(source_file: str, destination: str) -> None:
     logging.info(f"Cropping '{source_file}.jpg' to its middle third in both dimensions...")
     image = jpeglib.read_dct(source_file)
 
-    # only keep the middle third of the image in both dimensions
-    image.Y = image.Y[image.Y.shape[0] // 3: 2 * image.Y.shape[0] // 3,
-                      image.Y.shape[1] // 3: 2 * image.Y.shape[1] // 3]
-    logging.info(f"Cropped Y channel.")
-
-    image.Cr = image.Cr[image.Cr.shape[0] // 3: 2 * image.Cr.shape[0] // 3,
-                        image.Cr.shape[1] // 3: 2 * image.Cr.shape[1] // 3]
-    logging.info(f"Cropped Cr channel.")
+    # the chroma channels may be subsampled, so the bounds are computed in their resolution and scaled up for the Y
+    # channel, otherwise the cropped channels no longer have matching dimensions
+    vertical_sampling_factor = -(-image.Y.shape[0] // image.Cr.shape[0])
+    horizontal_sampling_factor = -(-image.Y.shape[1] // image.Cr.shape[1])
+    rows, columns = compute_middle_third_bounds(*image.Cr.shape[:2])
 
-    image.Cb = image.Cb[image.Cb.shape[0] // 3: 2 * image.Cb.shape[0] // 3,
-                        image.Cb.shape[1] // 3: 2 * image.Cb.shape[1] // 3]
-    logging.info(f"Cropped Cb channel.")
+    image.Cr, image.Cb = image.Cr[rows, columns], image.Cb[rows, columns]
+    image.Y = image.Y[rows.start * vertical_sampling_factor: rows.stop * vertical_sampling_factor,
+                      columns.start * horizontal_sampling_factor: columns.stop * horizontal_sampling_factor]
+    logging.info("Cropped Y, Cr and Cb channels.")
 
     image.height = image.Y.shape[0] * 8
     image.width = image.Y.shape[1] * 8
@@ -88,70 +147,100 @@ def crop_jpeg(source_file: str, destination: str) -> None:
 
 def crop_png(source_file: str, destination: str) -> None:
     logging.info(f"Cropping '{source_file}.png' to its middle third in both dimensions...")
-    image = cv2.imread(source_file, cv2.IMREAD_UNCHANGED)
-    temporary_image = pyexiv2.Image(source_file)
+    with open(source_file, "rb") as file:
+        source = file.read()
+
+    image = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    temporary_image = pyexiv2.ImageData(source)
     exif = temporary_image.read_exif()
     temporary_image.close()
 
-    image = image[image.shape[0] // 3: 2 * image.shape[0] // 3,
-                  image.shape[1] // 3: 2 * image.shape[1] // 3]
+    image = middle_third(image)
     logging.info("Cropped image.")
 
-    cv2.imwrite(destination, image, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-    temporary_image = pyexiv2.Image(destination)
+    # PNG is lossless, so the compression level only trades file size for speed
+    _, destination_image = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    temporary_image = pyexiv2.ImageData(destination_image.tobytes())
     temporary_image.modify_exif(exif)
+    with open(destination, "wb") as file:
+        file.write(temporary_image.get_bytes())
     temporary_image.close()
 
 
+def count_occurrences(source: mmap.mmap, pattern: bytes) -> int:
+    # mmap objects have no count method
+    if not pattern:
+        return len(source) + 1
+
+    number_of_occurrences = 0
+    position = source.find(pattern)
+    while position != -1:
+        number_of_occurrences += 1
+        position = source.find(pattern, position + len(pattern))
+
+    return number_of_occurrences
+
+
 def recover(source_file: str, pattern_file: str) -> None:
     logging.info(f"Loading '{source_file}' source file from disk...")
     with open(source_file, "rb") as file:
-        source = file.read()
+        mapped_source = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
 
     logging.info(f"Loading '{pattern_file}' pattern file from disk...")
     with open(pattern_file, "rb") as file:
-        # make sure the content of the binary isn't interpreted as regex syntax
-        pattern = re.escape(file.read())
+        pattern = file.read()
 
     # initialize with the number of occurrences when no leading bits are removed
-    number_of_matches = [len(re.findall(pattern, source))]
+    number_of_matches = [count_occurrences(mapped_source, pattern)]
+
+    source = np.frombuffer(mapped_source, dtype=np.uint8)
+    shifted_source = bytearray(len(source))
+    current_source = np.frombuffer(shifted_source, dtype=np.uint8)
 
-    source_as_bits = bitarray()
-    source_as_bits.frombytes(source)
+    for leading_bits_removed in range(1, 8):
+        # each byte is made up of its own trailing bits and the leading bits of the next byte, while the
+        # last byte is padded with 0s
+        np.left_shift(source, leading_bits_removed, out=current_source)
+        current_source[:-1] |= source[1:] >> (8 - leading_bits_removed)
+        number_of_matches.append(shifted_source.count(pattern))
 
-    for _ in range(1, 8):
-        source_as_bits.pop(0)
-        current_source = source_as_bits.tobytes()
-        number_of_matches.append(len(re.findall(pattern, current_source)))
+    # the mapping can't be closed while an array still refers to it
+    del source
+    mapped_source.close()
 
     maximum_number_of_matches = max(number_of_matches)
     leading_bits_removed = number_of_matches.index(maximum_number_of_matches)
     logging.info(f"Found {maximum_number_of_matches} matches of the pattern in the source file, after removing the leading {leading_bits_removed} bits.")
 
 
-def visual_attack_jpeg(source_file: str, destination: str, number_of_least_significant_bits: str, luminance_boost: str) -> None:
-    logging.info(f"Preparing bitmask for visual attack on '{source_file}'...")
+def compute_visual_attack_lookup_table(number_of_least_significant_bits: str, luminance_boost: str) -> np.ndarray:
+    logging.info("Preparing bitmask and luminance boost...")
     bitmask = 255 >> (8 - int(number_of_least_significant_bits))
 
+    return (np.arange(256, dtype=np.uint8) & bitmask) << int(luminance_boost)
+
+
+def visual_attack_jpeg(source_file: str, destination: str, number_of_least_significant_bits: str, luminance_boost: str) -> None:
+    logging.info(f"Preparing visual attack on '{source_file}'...")
+    lookup_table = compute_visual_attack_lookup_table(number_of_least_significant_bits, luminance_boost)
+
     image = cv2.imread(source_file, cv2.IMREAD_UNCHANGED)
-    image &= bitmask
-    logging.info("Bitmask applied.")
+    image = cv2.LUT(image, lookup_table)
+    logging.info("Bitmask applied and luminance boosted.")
 
-    image <<= int(luminance_boost)
-    logging.info("Luminance boosted.")
     cv2.imwrite(destination, image)
 
 
 def visual_attack_png(source_file: str, destination: str, number_of_least_significant_bits: str, luminance_boost: str) -> None:
-    logging.info(f"Preparing bitmask for visual attack on '{source_file}'...")
-    bitmask = 255 >> (8 - int(number_of_least_significant_bits))
+    logging.info(f"Preparing visual attack on '{source_file}'...")
+    lookup_table = compute_visual_attack_lookup_table(number_of_least_significant_bits, luminance_boost)
 
     image = cv2.imread(source_file, cv2.IMREAD_UNCHANGED)
-    image[:, :, [0, 1, 2]] &= bitmask
-    logging.info("Bitmask applied.")
+    # the alpha channel, if present, is left untouched
+    color_channels = image[:, :, :3]
+    color_channels[...] = cv2.LUT(color_channels, lookup_table)
+    logging.info("Bitmask applied and luminance boosted.")
 
-    image[:, :, [0, 1, 2]] <<= int(luminance_boost)
-    logging.info("Luminance boosted.")
     cv2.imwrite(destination, image)
 
 
@@ -167,6 +256,8 @@ def main(args):
         psnr(*args.psnr)
     elif args.ssim:
         ssim(*args.ssim)
+    elif args.quality:
+        quality_metrics(*args.quality)
     elif args.crop:
         if args.type_of_image == "jpeg":
             crop_jpeg(*args.crop)
@@ -197,6 +288,7 @@ if __name__ == "__main__":
     group.add_argument("-i", "--histogram", nargs=2, metavar=("SOURCE-FILE", "DESTINATION"))
     group.add_argument("-psnr", "--peak-signal-to-noise-ratio", dest="psnr", nargs=2, metavar=("IMAGE-FILE", "STEGO-FILE"))
     group.add_argument("-ssim", "--structural-similarity", dest="ssim", nargs=2, metavar=("IMAGE-FILE", "STEGO-FILE"))
+    group.add_argument("-q", "--quality", nargs=2, metavar=("IMAGE-FILE", "STEGO-FILE"))
     group.add_argument("-c", "--crop", nargs=2, metavar=("SOURCE-FILE", "DESTINATION"))
     group.add_argument("-r", "--recover", nargs=2, metavar=("SOURCE-FILE", "DATA-TO-SEARCH-FOR"))
     group.add_argument("-v", "--visual-attack", nargs=4, metavar=("SOURCE-FILE", "DESTINATION", "NUMBER-OF-LEAST-SIGNIFICANT-BITS", "LUMINANCE-BOOST"))
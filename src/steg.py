@@ -27,7 +27,8 @@ def data_embedding(args):
             data *= image.storage_capacity // len(data)
 
     try:
-        stego_image = image.embed_data(data)
+        # the cover image is discarded after embedding, so it doesn't have to be copied
+        stego_image = image.embed_data(data, copy=False)
         logging.info("Writing stego image to disk.")
         stego_image.to_file(args.output_image)
     except ValueError:
@@ -1,12 +1,38 @@
 import logging
+import os
 import numpy as np
 import jpeglib
 import pyexiv2
 
-from bitarray import bitarray
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, lru_cache
 from . import common_operations
 
 
+# the cached masks are shared between images, so they are read-only
+@lru_cache(maxsize=8)
+def compute_perceptibility_mask(perceptibility: int) -> np.ndarray:
+    # the positions (k, l) of each 8x8 DCT block which are used to store data
+    mask = np.zeros((8, 8), dtype=bool)
+    for k in range(8):
+        mask[k, max(0, 8 - k - perceptibility):] = True
+
+    mask.flags.writeable = False
+    return mask
+
+
+def compute_usable_coefficients(coefficients: np.ndarray) -> np.ndarray:
+    # reinterpreted as unsigned, negative coefficients become larger than 1, so a single comparison excludes both 0 and 1
+    return coefficients.view(np.uint16) > 1
+
+
+def compute_available_coefficients(image_channel: np.ndarray, perceptibility_mask: np.ndarray) -> np.ndarray:
+    available_coefficients = compute_usable_coefficients(image_channel)
+    available_coefficients &= perceptibility_mask
+
+    return available_coefficients
+
+
 class StegJpegImage:
     def __init__(self, steg_image: jpeglib.dct_jpeg.DCTJPEG, exif: dict):
         self.steg_image = steg_image
@@ -33,47 +59,43 @@ class StegJpegImage:
         temporary_image.modify_exif(self.exif)
         temporary_image.close()
 
-    def __extract_data_from_channel(self, image_channel: np.ndarray, data_size: int, data: bitarray, perceptibility: int) -> (int, bitarray):
-        for i in range(image_channel.shape[0]):
-            for j in range(image_channel.shape[1]):
-                for k in range(8):
-                    for l in range(max(0, 8 - k - perceptibility), 8):
-                        if image_channel[i][j][k][l] not in [0, 1]:
-                            data.append(int(image_channel[i][j][k][l]) % 2)
-                            data_size -= 1
-
-                            if not data_size:
-                                return data_size, data
+    def __extract_data_from_channel(self, image_channel: np.ndarray, data: np.ndarray, index: int, perceptibility_mask: np.ndarray) -> int:
+        positions = np.flatnonzero(compute_available_coefficients(image_channel, perceptibility_mask))[:len(data) - index]
+        coefficients = image_channel.reshape(-1)
 
-        return data_size, data
+        # in two's complement, the least significant bit is also the parity of negative coefficients
+        data[index:index + len(positions)] = coefficients[positions] & 1
+        return index + len(positions)
 
     def extract(self) -> bytes:
         logging.info("Extracting metadata from EXIF.")
         metadata = self.exif.get("Exif.Photo.UserComment")
         data_size, perceptibility = common_operations.extract_parameters_from_metadata(metadata, 'perceptibility', range(1, 9))
+        perceptibility_mask = compute_perceptibility_mask(perceptibility)
 
         logging.info("Attempting to extract data from image.")
-        data = bitarray()
-
-        data_size, data = self.__extract_data_from_channel(self.steg_image.Y, data_size, data, perceptibility)
-        logging.debug(f"Extracted data from Y channel. Total size of extracted data: {len(data)} bits. Remaining: {data_size} bits.")
-        if not data_size:
-            return data.tobytes()
-
-        data_size, data = self.__extract_data_from_channel(self.steg_image.Cr, data_size, data, perceptibility)
-        logging.debug(f"Extracted data from Cr channel. Total size of extracted data: {len(data)} bits. Remaining: {data_size} bits.")
-        if not data_size:
-            return data.tobytes()
-
-        data_size, data = self.__extract_data_from_channel(self.steg_image.Cb, data_size, data, perceptibility)
-        logging.debug(f"Extracted data from Cb channel. Total size of extracted data: {len(data)} bits. Remaining: {data_size} bits.")
-        if data_size:
+        # the image can't hold more bits than it has coefficients, regardless of the size read from the EXIF
+        data = np.empty(min(data_size, self.steg_image.Y.size + self.steg_image.Cr.size + self.steg_image.Cb.size), dtype=np.uint8)
+
+        index = self.__extract_data_from_channel(self.steg_image.Y, data, 0, perceptibility_mask)
+        logging.debug(f"Extracted data from Y channel. Total size of extracted data: {index} bits. Remaining: {data_size - index} bits.")
+        if index == data_size:
+            return np.packbits(data).tobytes()
+
+        index = self.__extract_data_from_channel(self.steg_image.Cr, data, index, perceptibility_mask)
+        logging.debug(f"Extracted data from Cr channel. Total size of extracted data: {index} bits. Remaining: {data_size - index} bits.")
+        if index == data_size:
+            return np.packbits(data).tobytes()
+
+        index = self.__extract_data_from_channel(self.steg_image.Cb, data, index, perceptibility_mask)
+        logging.debug(f"Extracted data from Cb channel. Total size of extracted data: {index} bits. Remaining: {data_size - index} bits.")
+        if index != data_size:
             logging.warning(f"Could not extract embedded data completely. The size of the embedded data, as it was read from the "
-                            f"EXIF of the image, exceeds the storage capacity of the image. A total of {len(data)} bits were read, "
-                            f"and the last {data_size} bits are missing. This might be due to cropping, EXIF modifications or other "
+                            f"EXIF of the image, exceeds the storage capacity of the image. A total of {index} bits were read, "
+                            f"and the last {data_size - index} bits are missing. This might be due to cropping, EXIF modifications or other "
                             f"alterations produced by different software")
 
-        return data.tobytes()
+        return np.packbits(data[:index]).tobytes()
 
 
 class JpegImage:
@@ -81,7 +103,7 @@ class JpegImage:
         self.image = image
         self.exif = exif
         self.perceptibility = perceptibility
-        self.storage_capacity = self.__compute_storage_capacity()
+        self.perceptibility_mask = compute_perceptibility_mask(perceptibility)
 
     @classmethod
     def from_file(cls, image_path: str, perceptibility: int = 3):
@@ -99,52 +121,67 @@ class JpegImage:
 
         return cls(image, exif, perceptibility)
 
-    def __compute_number_of_available_coefficients(self, image_channel: np.ndarray) -> int:
-        number_of_available_coefficients = 0
+    @classmethod
+    def capacity_table(cls, image_path: str) -> dict:
+        logging.debug(f"Decoding DCT blocks from JPEG file '{image_path}'.")
+        image = jpeglib.read_dct(image_path)
 
-        for i in range(image_channel.shape[0]):
-            for j in range(image_channel.shape[1]):
-                for k in range(8):
-                    for l in range(max(0, 8 - k - self.perceptibility), 8):
-                        if image_channel[i][j][k][l] not in [0, 1]:
-                            number_of_available_coefficients += 1
+        logging.info("Computing storage capacity of image for every perceptibility.")
+        # the masks of higher perceptibilities include those of lower ones, so each capacity is a sum over these counts
+        available_coefficients_per_position = sum(
+            compute_available_coefficients(image_channel, compute_perceptibility_mask(8)).sum(axis=(0, 1))
+            for image_channel in [image.Y, image.Cr, image.Cb])
 
-        return number_of_available_coefficients
+        # the storage capacities are in bytes
+        return {perceptibility: int(available_coefficients_per_position[compute_perceptibility_mask(perceptibility)].sum()) // 8
+                for perceptibility in range(1, 9)}
 
-    def __compute_storage_capacity(self) -> int:
+    def __compute_number_of_available_coefficients(self, image_channel: np.ndarray) -> int:
+        return np.count_nonzero(compute_available_coefficients(image_channel, self.perceptibility_mask))
+
+    @cached_property
+    def storage_capacity(self) -> int:
         logging.info("Computing storage capacity of image.")
 
-        storage_capacity_in_Y = self.__compute_number_of_available_coefficients(self.image.Y)
+        # NumPy releases the GIL while counting, so bands of block rows are counted on separate threads
+        number_of_bands = os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=number_of_bands) as executor:
+            storage_capacity_in_Y, storage_capacity_in_Cr, storage_capacity_in_Cb = (
+                sum(executor.map(self.__compute_number_of_available_coefficients, np.array_split(image_channel, number_of_bands)))
+                for image_channel in [self.image.Y, self.image.Cr, self.image.Cb])
+
         logging.debug(f"Storage capacity in the Y channel: {storage_capacity_in_Y} bits.")
-        storage_capacity_in_Cr = self.__compute_number_of_available_coefficients(self.image.Cr)
         logging.debug(f"Storage capacity in the Cr channel: {storage_capacity_in_Cr} bits.")
-        storage_capacity_in_Cb = self.__compute_number_of_available_coefficients(self.image.Cb)
         logging.debug(f"Storage capacity in the Cb channel: {storage_capacity_in_Cb} bits.")
 
         # return the storage capacity in bytes
         return (storage_capacity_in_Y + storage_capacity_in_Cr + storage_capacity_in_Cb) // 8
 
-    def __embed_data_into_channel(self, image_channel: np.ndarray, data: bitarray, index: int = 0) -> int:
-        for i in range(image_channel.shape[0]):
-            for j in range(image_channel.shape[1]):
-                for k in range(8):
-                    for l in range(max(0, 8 - k - self.perceptibility), 8):
-                        if image_channel[i][j][k][l] not in [0, 1]:
-                            # apply bitmasks
-                            if data[index] == 0:
-                                image_channel[i][j][k][l] &= -2
-                            else:
-                                image_channel[i][j][k][l] |= 1
+    def __fits_into_storage_capacity(self, data_size: int) -> bool:
+        if "storage_capacity" in self.__dict__:
+            return data_size <= self.storage_capacity
+
+        # otherwise, only as many channels as needed are counted, in the order in which they are used for embedding
+        number_of_available_coefficients = 0
+        for image_channel in [self.image.Y, self.image.Cr, self.image.Cb]:
+            number_of_available_coefficients += self.__compute_number_of_available_coefficients(image_channel)
+            if data_size <= number_of_available_coefficients // 8:
+                return True
+
+        return False
 
-                            index += 1
+    def __embed_data_into_channel(self, image_channel: np.ndarray, data: np.ndarray, index: int = 0) -> int:
+        positions = np.flatnonzero(compute_available_coefficients(image_channel, self.perceptibility_mask))[:len(data) - index]
+        # the channels of the image are C-contiguous, so this is a view which can be written through
+        coefficients = image_channel.reshape(-1)
 
-                            if index == len(data):
-                                return index
+        # apply bitmasks
+        coefficients[positions] = (coefficients[positions] & -2) | data[index:index + len(positions)]
 
-        return index
+        return index + len(positions)
 
-    def embed_data(self, data: bytes) -> StegJpegImage:
-        if len(data) > self.storage_capacity:
+    def embed_data(self, data: bytes, copy: bool = True) -> StegJpegImage:
+        if not self.__fits_into_storage_capacity(len(data)):
             logging.error("Size of data exceeds storage capacity of image.")
             raise ValueError("Size of data exceeds storage capacity of image.")
 
@@ -154,9 +191,9 @@ class JpegImage:
         # The UserComment tag is rarely overwritten by other software
         self.exif["Exif.Photo.UserComment"] = metadata
 
-        image = self.image.copy()
-        bit_data = bitarray()
-        bit_data.frombytes(data)
+        # copy=False writes into self.image
+        image = self.image.copy() if copy else self.image
+        bit_data = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
 
         logging.info("Embedding data into image.")
         index = self.__embed_data_into_channel(image.Y, bit_data)
@@ -3,7 +3,6 @@ import numpy as np
 import cv2
 import pyexiv2
 
-from bitarray import bitarray
 from . import common_operations
 
 
@@ -39,24 +38,18 @@ class StegPngImage:
         data_size, number_of_least_significant_bits = common_operations.extract_parameters_from_metadata(metadata, 'number_of_significant_bits', range(1, 5))
 
         logging.info("Attempting to extract data from image.")
-        data = bitarray()
-
-        for i in range(self.steg_image.shape[0]):
-            for j in range(self.steg_image.shape[1]):
-                for k in range(3):
-                    # get the last 'number_of_least_significant_bits' sized sub-string from the binary representation
-                    embedded_bits = f"{self.steg_image[i][j][k]:08b}"[-number_of_least_significant_bits:]
-                    data.extend(embedded_bits)
-                    data_size -= number_of_least_significant_bits
-
-                    if data_size <= 0:
-                        break
-                else:
-                    continue
-                break
-            else:
-                continue
-            break
+        # only the first 3 channels of a pixel hold data
+        number_of_values = -(-data_size // number_of_least_significant_bits)
+        number_of_pixels = -(-number_of_values // 3)
+        values = self.steg_image.reshape(-1, self.steg_image.shape[2])[:number_of_pixels, :3].reshape(-1)[:number_of_values]
+
+        if number_of_least_significant_bits == 1:
+            data = values & 1
+        else:
+            # the last 'number_of_least_significant_bits' bits of every value, most significant first
+            shifts = np.arange(number_of_least_significant_bits - 1, -1, -1, dtype=np.uint8)
+            data = ((values[:, np.newaxis] >> shifts) & 1).reshape(-1)
+        data_size -= len(data)
 
         # when the value of 'number_of_least_significant_bits' is 3, there might be up to 2 remaining
         # bits in the sequence of bits embedded in the last pixel value, which must be ignored
@@ -69,7 +62,7 @@ class StegPngImage:
                             f"and the last {data_size} bits are missing. This might be due to cropping, EXIF "
                             f"modifications or other alterations produced by different software")
 
-        return data.tobytes()
+        return np.packbits(data).tobytes()
 
 
 class PngImage:
@@ -99,7 +92,7 @@ class PngImage:
         logging.info("Computing storage capacity of image.")
         return (self.image.size * self.number_of_least_significant_bits) // 8
 
-    def embed_data(self, data: bytes) -> StegPngImage:
+    def embed_data(self, data: bytes, copy: bool = True) -> StegPngImage:
         if len(data) > self.storage_capacity:
             logging.error("Size of data exceeds storage capacity of image.")
             raise ValueError("Size of data exceeds storage capacity of image.")
@@ -110,33 +103,25 @@ class PngImage:
         # The UserComment tag is rarely overwritten by other software
         self.exif["Exif.Photo.UserComment"] = metadata
 
-        image = self.image.copy()
-        bit_data = bitarray()
-        bit_data.frombytes(data)
+        image = self.image.copy() if copy else self.image
+        bit_data = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+        if self.number_of_least_significant_bits == 1:
+            embedded_values = bit_data
+        else:
+            # padding with 0s to the right (when the data size isn't divisible by 'number_of_least_significant_bits')
+            bit_data = np.pad(bit_data, (0, -len(bit_data) % self.number_of_least_significant_bits))
+            embedded_values = np.packbits(bit_data.reshape(-1, self.number_of_least_significant_bits), axis=1)[:, 0] >> (8 - self.number_of_least_significant_bits)
 
         logging.info("Embedding data into image.")
-        for i in range(image.shape[0]):
-            for j in range(image.shape[1]):
-                for k in range(3):
-                    # indexing is much (MUCH) faster than deletion for bitarray objects
-                    left_bound = i * image.shape[1] * 3 * self.number_of_least_significant_bits + j * 3 * self.number_of_least_significant_bits + k * self.number_of_least_significant_bits
-                    right_bound = i * image.shape[1] * 3 * self.number_of_least_significant_bits + j * 3 * self.number_of_least_significant_bits + (k + 1) * self.number_of_least_significant_bits
-
-                    # representing a color channel value in binary form, on 8 bits, as a string, and substituting the
-                    # last 'number_of_least_significant_bits' bits with the corresponding bits in the covert data
-                    pixel_value = f"{image[i][j][k]:08b}"[:-self.number_of_least_significant_bits] + bit_data[left_bound:right_bound].to01()
-                    # padding with 0s to the right (when the data size isn't divisible by 3)
-                    pixel_value = pixel_value.ljust(8, '0')
-                    pixel_value = int(pixel_value, 2)
-                    image[i][j][k] = pixel_value
-
-                    if right_bound >= len(bit_data):
-                        break
-                else:
-                    continue
-                break
-            else:
-                continue
-            break
+        # only the first 3 channels of a pixel hold data, and any bits which don't fit into them are left out
+        color_channels = image.reshape(-1, image.shape[2])[:, :3]
+        embedded_values = embedded_values[:color_channels.size]
+        color_channels = color_channels[:-(-len(embedded_values) // 3)]
+
+        # the flattened values are a copy when the image has an alpha channel, so they are always written back
+        values = color_channels.reshape(-1)
+        bitmask = np.uint8(0xFF << self.number_of_least_significant_bits & 0xFF)
+        values[:len(embedded_values)] = (values[:len(embedded_values)] & bitmask) | embedded_values
+        color_channels[...] = values.reshape(color_channels.shape)
 
         return StegPngImage(image, self.exif)
@@ -3,7 +3,8 @@ import jpeglib
 import cv2
 import numpy as np
 
-from scipy.stats import chi2_contingency
+from scipy.stats import chi2
+from . import dct_steganography
 
 
 def lsb_detection(image_path, grayscale=False, alpha=0.05):
@@ -15,13 +16,13 @@ def lsb_detection(image_path, grayscale=False, alpha=0.05):
         lsb_values = pixel_values & 1
 
         # Count the occurrences of 0s and 1s 
-        observed_freq, _ = np.histogram(lsb_values, bins=range(3))
+        observed_freq = calculate_lsb_distribution(lsb_values)
 
         # Calculate the expected frequencies assuming no steganography (50% chance of 0 or 1)
         expected_freq = np.full_like(observed_freq, fill_value=len(lsb_values) / 2)
 
         # Chi-squared test
-        chi2_stat, p_value, _, _ = chi2_contingency([observed_freq, expected_freq])
+        p_value = compute_p_value(observed_freq, expected_freq)
         logging.debug(f"p-value = {p_value}")
 
         if p_value < alpha:
@@ -32,25 +33,17 @@ def lsb_detection(image_path, grayscale=False, alpha=0.05):
     else:
         image = cv2.imread(image_path)
 
-        pixel_values_r = image[0].flatten()
-        pixel_values_g = image[1].flatten()
-        pixel_values_b = image[2].flatten()
+        # OpenCV loads the color channels in BGR order
+        lsb_values = (image & 1).reshape(-1, 3)
+        ones_b, ones_g, ones_r = np.count_nonzero(lsb_values, axis=0)
+        number_of_pixels = len(lsb_values)
 
-        lsb_values_r = pixel_values_r & 1
-        lsb_values_g = pixel_values_g & 1
-        lsb_values_b = pixel_values_b & 1
+        observed_freq = np.array([[number_of_pixels - ones_b, ones_b],
+                                  [number_of_pixels - ones_g, ones_g],
+                                  [number_of_pixels - ones_r, ones_r]])
 
-        observed_freq_r, _ = np.histogram(lsb_values_r, bins=range(3))
-        observed_freq_g, _ = np.histogram(lsb_values_g, bins=range(3))
-        observed_freq_b, _ = np.histogram(lsb_values_b, bins=range(3))
-
-        expected_freq_r = np.full_like(observed_freq_r, fill_value=len(lsb_values_r) / 2)
-        expected_freq_g = np.full_like(observed_freq_g, fill_value=len(lsb_values_g) / 2)
-        expected_freq_b = np.full_like(observed_freq_b, fill_value=len(lsb_values_b) / 2)
-
-        chi2_stat_r, p_value_r, _, _ = chi2_contingency([observed_freq_r, expected_freq_r])
-        chi2_stat_g, p_value_g, _, _ = chi2_contingency([observed_freq_g, expected_freq_g])
-        chi2_stat_b, p_value_b, _, _ = chi2_contingency([observed_freq_b, expected_freq_b])
+        expected_freq = np.full_like(observed_freq[0], fill_value=number_of_pixels / 2)
+        p_value_b, p_value_g, p_value_r = compute_p_value(observed_freq, expected_freq)
 
         logging.debug(f"p-value for red channel: {p_value_r}")
         logging.debug(f"p-value for green channel: {p_value_g}")
@@ -64,56 +57,57 @@ def lsb_detection(image_path, grayscale=False, alpha=0.05):
 
 def dct_detection(image_path, grayscale=False, alpha=0.05):
     dct = jpeglib.read_dct(image_path)
-    y_coefficients = dct.Y
-    # Remove the 0s and the 1s
-    y_coefficients = y_coefficients[(y_coefficients != 0) & (y_coefficients != 1)]
-
-    observed_y = calculate_dct_distribution(y_coefficients)
-    expected_y = calculate_expected_frequency(y_coefficients)
+    channels = ["Y"] if grayscale else ["Y", "Cr", "Cb"]
 
-    chi2_stat_y, p_value_y, _, _ = chi2_contingency([observed_y, expected_y])
-    logging.debug(f"p-value for Y channel = {p_value_y}")
-    
-    if not grayscale:
-        cr_coefficients = dct.Cr
-        cb_coefficients = dct.Cb
-    
-        cr_coefficients = cr_coefficients[(cr_coefficients != 0) & (cr_coefficients != 1)]
-        cb_coefficients = cb_coefficients[(cb_coefficients != 0) & (cb_coefficients != 1)]
+    observed_freq = []
+    expected_freq = []
+    for channel in channels:
+        observed_freq.append(calculate_dct_distribution(getattr(dct, channel)))
+        expected_freq.append(calculate_expected_frequency(observed_freq[-1].sum()))
 
-        observed_cr = calculate_dct_distribution(cr_coefficients)
-        observed_cb = calculate_dct_distribution(cb_coefficients)
+    p_values = compute_p_value(np.array(observed_freq), np.array(expected_freq))
+    for channel, p_value in zip(channels, p_values):
+        logging.debug(f"p-value for {channel} channel = {p_value}")
 
-        expected_cr = calculate_expected_frequency(cr_coefficients)
-        expected_cb = calculate_expected_frequency(cb_coefficients)
-
-        chi2_stat_cr, p_value_cr, _, _ = chi2_contingency([observed_cr, expected_cr])
-        chi2_stat_cb, p_value_cb, _, _ = chi2_contingency([observed_cb, expected_cb])
-
-        logging.debug(f"p-value for Cr channel = {p_value_cr}")
-        logging.debug(f"p-value for Cb channel = {p_value_cb}")
-
-    if grayscale:
-        dct_detected = p_value_y < alpha
-    else:
-        dct_detected = any(p_value < alpha for p_value in [p_value_y, p_value_cr, p_value_cb])
-    
-    if dct_detected:
+    if np.any(p_values < alpha):
         logging.info("DCT steganography detected!")
     else:
         logging.info("No evidence of DCT steganography.")
 
 
+def calculate_lsb_distribution(lsb_values):
+    ones = np.count_nonzero(lsb_values)
+    return np.array([lsb_values.size - ones, ones])
+
+
 def calculate_dct_distribution(coefficients):
-    lsb_values = coefficients & 1
-    observed_freq, _ = np.histogram(lsb_values, bins=range(3))
-    return observed_freq
+    # the coefficients JSTEG can embed into, which are neither 0 nor 1
+    available_coefficients = dct_steganography.compute_usable_coefficients(coefficients)
+    ones = np.count_nonzero(np.logical_and(coefficients & 1, available_coefficients))
+    return np.array([np.count_nonzero(available_coefficients) - ones, ones])
 
 
-def calculate_expected_frequency(coefficients):
-    total = len(coefficients)
+def calculate_expected_frequency(total):
     freq1 = freq2 = total // 2
     if total % 2 == 1:
         freq2 += 1
     
     return np.array([freq1, freq2])
+
+
+def compute_p_value(observed_freq, expected_freq):
+    # chi-squared test of independence (with Yates' correction) on the 2x2 table made up of the observed and the
+    # expected frequencies, as done by scipy.stats.chi2_contingency; several tables can be stacked along the first axis
+    observed_freq = np.asarray(observed_freq, dtype=float)
+    expected_freq = np.asarray(expected_freq, dtype=float)
+    a, b = observed_freq[..., 0], observed_freq[..., 1]
+    c, d = expected_freq[..., 0], expected_freq[..., 1]
+
+    total = a + b + c + d
+    denominator = (a + b) * (c + d) * (a + c) * (b + d)
+    if np.any(denominator == 0):
+        raise ValueError("The internally computed table of expected frequencies has a zero element.")
+
+    difference = np.abs(a * d - b * c)
+    chi2_stat = total * (difference - np.minimum(total / 2, difference)) ** 2 / denominator
+    return chi2.sf(chi2_stat, 1)